@@ -0,0 +1,111 @@
+# cython: language_level=3
+# This module parses a line of comma separated sensor data, as sent by raw_data.ino
+# or raw_data_mul.ino, into a row of the data block of a .bmerawdata file.
+# rawdata.py and rawdata_auto.py use it instead of their Python parser if it has been built.
+# Both parsers accept and reject the same lines, see test_parse_row.py.
+
+# Build with: python setup.py build_ext --inplace
+
+cimport cython
+from libc.stdlib cimport strtoll, strtod
+from libc.math cimport HUGE_VAL, fabs
+from libc cimport errno
+
+cdef inline bint isSpace(char c):
+    # Whitespace that int() and float() strip from an ASCII string
+    return c == 32 or 9 <= c <= 13
+
+cdef long long parseInt(bytes data, char* base, char* start, char* stop) except? -1:
+    # Parse an integer field between start and stop. Plain decimal numbers are parsed with
+    # strtoll(), anything else (e.g. underscores) is left to int(), like in the Python parser
+    cdef char* c
+    cdef char* end
+    cdef long long value
+    while start < stop and isSpace(start[0]):
+        start += 1
+    while stop > start and isSpace(stop[-1]):
+        stop -= 1
+    c = start
+    while c < stop and (c'0' <= c[0] <= c'9' or c[0] == c'+' or c[0] == c'-'):
+        c += 1
+    if c == stop:
+        errno.errno = 0
+        value = strtoll(start, &end, 10)
+        if end == start or end != stop or errno.errno == errno.ERANGE: # Outside int64
+            raise ValueError('Could not parse raw data line')
+        return value
+    pyValue = int(data[start - base:stop - base])
+    if not -2**63 <= pyValue < 2**63:
+        raise ValueError('Could not parse raw data line')
+    return pyValue
+
+cdef double parseFloat(bytes data, char* base, char* start, char* stop) except? -1.0:
+    # Parse a float field between start and stop. Plain decimal numbers are parsed with strtod(),
+    # anything else (e.g. inf, nan, underscores, but also hexadecimal numbers, which strtod()
+    # accepts and float() does not) is left to float(), like in the Python parser
+    cdef char* c
+    cdef char* end
+    cdef double value
+    while start < stop and isSpace(start[0]):
+        start += 1
+    while stop > start and isSpace(stop[-1]):
+        stop -= 1
+    c = start
+    while c < stop and (c'0' <= c[0] <= c'9' or c[0] == c'+' or c[0] == c'-' or c[0] == c'.' or c[0] == c'e' or c[0] == c'E'):
+        c += 1
+    if c == stop:
+        errno.errno = 0
+        value = strtod(start, &end)
+        # Overflow is rejected, underflow gives the nearest representable value like float()
+        if end == start or end != stop or (errno.errno == errno.ERANGE and fabs(value) == HUGE_VAL):
+            raise ValueError('Could not parse raw data line')
+        return value
+    field = data[start - base:stop - base]
+    pyValue = float(field)
+    if fabs(pyValue) == HUGE_VAL and b'inf' not in field.lower(): # Overflow
+        raise ValueError('Could not parse raw data line')
+    return pyValue
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef tuple parse_row(bytes data, long long now_s):
+    """Parse a line of raw data from the board into a data block row, with now_s as real time clock"""
+    cdef char* base = data
+    cdef char* stop = base + len(data)
+    cdef char* c = base
+    cdef char* fieldStart[9]
+    cdef char* fieldEnd[9]
+    cdef int fields = 0
+    cdef long long sensorIndex, sensorID, timestamp, errCode, heaterIndex
+    cdef double temp, press, hum, gasResis
+
+    # Find the first nine comma separated fields. Like decode('ascii') in the Python parser,
+    # any byte that is not ASCII rejects the line, even after the ninth field
+    fieldStart[0] = base
+    while c < stop:
+        if <unsigned char>c[0] >= 128:
+            raise ValueError('Could not parse raw data line')
+        if c[0] == c',' and fields < 9:
+            fieldEnd[fields] = c
+            fields += 1
+            if fields < 9:
+                fieldStart[fields] = c + 1
+        c += 1
+    if fields == 8:
+        fieldEnd[8] = stop
+        fields = 9
+    if fields < 9: # Line is missing fields
+        raise ValueError('Could not parse raw data line')
+
+    sensorIndex = parseInt(data, base, fieldStart[0], fieldEnd[0])
+    sensorID = parseInt(data, base, fieldStart[1], fieldEnd[1])
+    timestamp = parseInt(data, base, fieldStart[2], fieldEnd[2])
+    temp = parseFloat(data, base, fieldStart[3], fieldEnd[3])
+    press = parseFloat(data, base, fieldStart[4], fieldEnd[4])
+    hum = parseFloat(data, base, fieldStart[5], fieldEnd[5])
+    gasResis = parseFloat(data, base, fieldStart[6], fieldEnd[6])
+    heaterIndex = parseInt(data, base, fieldStart[8], fieldEnd[8]) # Heater profile Step index
+    errCode = parseInt(data, base, fieldStart[7], fieldEnd[7])
+
+    # Scanning mode is always enabled and rows are not labelled (label tag 0)
+    return (sensorIndex, sensorID, timestamp, now_s, temp, press, hum, gasResis, heaterIndex, 1, 0, errCode)
@@ -4,15 +4,176 @@
 
 # BEFORE running this program, please open Arduino and upload raw_data.ino to board.
 
-import serial, time, json, glob, random, datetime
-from json import JSONDecodeError
+import serial, time, secrets, datetime, os, struct, itertools, math
+import numpy as np
+from pathlib import Path
+
+# Use orjson for (de)serializing JSON if installed, fall back to ujson and then
+# the json standard library. dumpJson() always returns bytes, like orjson.dumps()
+try:
+    import orjson
+    dumpJson = orjson.dumps
+    loadJson = orjson.loads
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+    dumpJson = lambda obj: json.dumps(obj).encode()
+    loadJson = json.loads
+
+# Use the compiled parse_row extension if it has been built (see setup.py),
+# otherwise parse the comma separated raw data from the board in Python
+try:
+    from parse_row import parse_row
+except ImportError:
+    int64 = range(-2**63, 2**63) # Integers that fit in the rows file
+
+    def parse_row(data, now_s):
+        """Parse a line of raw data from the board into a data block row, with now_s as real time clock"""
+        # Get comma separated raw data (UnicodeDecodeError is a ValueError, like any other parse error)
+        arduinoData = data.decode('ascii').split(',')
+        if len(arduinoData) < 9: # Line is missing fields
+            raise ValueError('Could not parse raw data line')
+
+        # Label raw data from comma seperated output
+        sensorIndex = int(arduinoData[0])
+        sensorID = int(arduinoData[1])
+        timestamp = int(arduinoData[2])
+        temp = float(arduinoData[3])
+        press = float(arduinoData[4])
+        hum = float(arduinoData[5])
+        gasResis = float(arduinoData[6])
+        heaterIndex = int(arduinoData[8]) # Heater profile Step index
+        scanMode = 1
+        labelTag = 0
+        errCode = int(arduinoData[7])
+
+        # Reject integers outside int64 and floats that overflow to infinity (but not "inf" itself),
+        # like parse_row.pyx. The sum is only not finite if a value is infinite or not a number
+        if not (sensorIndex in int64 and sensorID in int64 and timestamp in int64 and heaterIndex in int64 and errCode in int64):
+            raise ValueError('Could not parse raw data line')
+        if not math.isfinite(temp + press + hum + gasResis):
+            for field in arduinoData[3:7]:
+                if math.isinf(float(field)) and 'inf' not in field.lower():
+                    raise ValueError('Could not parse raw data line')
+
+        return (sensorIndex, sensorID, timestamp, now_s, temp, press, hum, gasResis, heaterIndex, scanMode, labelTag, errCode)
+
+# Size of the write buffers of the raw data and rows files, and number of rows
+# converted from the rows file to the raw data file at a time at the end of the session
+writeBufferSize = 64 * 1024
+chunkSize = 4096
+
+# Number of rows after which the rows file is flushed to disk
+# (rows collected since the last flush are lost on a crash)
+flushInterval = 100
+
+# Set debug to True to print every row to the console for sanity checks, otherwise
+# the number of collected rows is printed every progressInterval rows
+debug = False
+progressInterval = 1000
+
+# Data columns of the data block (within raw data body), in the order of the values in each row
+dataColumns = (
+    {"name": "Sensor Index","unit": "","format": "integer","key": "sensor_index"},
+    {"name": "Sensor ID","unit": "","format": "integer","key": "sensor_id"},
+    {"name": "Time Since PowerOn","unit": "Milliseconds","format": "integer","key": "timestamp_since_poweron"},
+    {"name": "Real time clock","unit": "Unix Timestamp: seconds since Jan 01 1970. (UTC); 0 = missing","format": "integer","key": "real_time_clock"},
+    {"name": "Temperature","unit": "DegreesCelcius","format": "float","key": "temperature"},
+    {"name": "Pressure","unit": "Hectopascals","format": "float","key": "pressure"},
+    {"name": "Relative Humidity","unit": "Percent","format": "float","key": "relative_humidity"},
+    {"name": "Resistance Gassensor","unit": "Ohms","format": "float","key": "resistance_gassensor"},
+    {"name": "Heater Profile Step Index","unit": "","format": "integer","key": "heater_profile_step_index"},
+    {"name": "Scanning Mode Enabled","unit": "","format": "integer","key": "scanning_mode_enabled"},
+    {"name": "Label Tag","unit": "","format": "integer","key": "label_tag"},
+    {"name": "Error Code","unit": "","format": "integer","key": "error_code"},
+)
+
+# Each row is saved in the rows file as one integer (int64) or float (float64) per data column,
+# little-endian and in the order of dataColumns. packRow() and rowDtype describe the same layout
+rowFormat = '<' + ''.join('q' if column['format'] == 'integer' else 'd' for column in dataColumns)
+packRow = struct.Struct(rowFormat).pack
+rowDtype = np.dtype([(column['key'], '<i8' if column['format'] == 'integer' else '<f8') for column in dataColumns])
+
+# Lock a rows file while its session writes to it, so that another session (e.g. of a second
+# board) does not convert it as a leftover. The lock is released when the file is closed or the
+# session ends in any way, including a crash
+if os.name == 'nt':
+    import msvcrt
+
+    def lockFile(file):
+        """Lock an open file, return False if another process has locked it"""
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1) # Lock the first byte
+            return True
+        except OSError:
+            return False
+else:
+    import fcntl
+
+    def lockFile(file):
+        """Lock an open file, return False if another process has locked it"""
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+def convertRows(rawDataFileName, rowsFile):
+    """Write the rows in an open rows file to the data block of its raw data file as json,
+    then close the data block, raw data body and raw data json"""
+    with open(rawDataFileName, 'r+b', buffering=writeBufferSize) as rawDataFile:
+        # Drop everything after the opening bracket of the data block, e.g. rows written by an
+        # interrupted conversion, so a rows file can be converted again. Rows only contain
+        # numbers, so the last "dataBlock" in the file is the key of the data block
+        rawData = rawDataFile.read()
+        rawDataFile.seek(rawData.index(b'[', rawData.rindex(b'"dataBlock"')) + 1)
+        rawDataFile.truncate()
+
+        # Convert chunkSize rows at a time. An incomplete last row (cut off by a crash) is skipped
+        rowsFile.seek(0) # Also writes any buffered rows to the file
+        rowCount = os.fstat(rowsFile.fileno()).st_size // rowDtype.itemsize
+        for start in range(0, rowCount, chunkSize):
+            rows = np.fromfile(rowsFile, dtype=rowDtype, count=min(chunkSize, rowCount - start))
+            if start > 0: # Comma between previously written rows and these rows
+                rawDataFile.write(b',')
+            rawDataFile.write(dumpJson(rows.tolist())[1:-1]) # Strip the brackets of the list of rows
+        rawDataFile.write(b']}}')
+
+# Convert rows files left behind by sessions that did not end normally (e.g. power loss). This
+# runs before connecting to the board, so it also works while no board is connected
+for leftoverRowsFile in Path('.').glob('*.rows.bin'):
+    leftoverRowsFileName = str(leftoverRowsFile)
+    leftoverFileName = leftoverRowsFileName[:-len('.rows.bin')] + '.bmerawdata'
+    try:
+        with open(leftoverRowsFileName, 'rb') as rowsFile:
+            if not lockFile(rowsFile):
+                print(f'Skipping {leftoverRowsFileName}, another measurement session is still writing to it')
+                continue
+            convertRows(leftoverFileName, rowsFile)
+        os.remove(leftoverRowsFileName) # All rows are saved in the raw data file now
+        print(f'Saved rows of an unfinished measurement session to {leftoverFileName}')
+    except (OSError, ValueError):
+        print(f'Could not save rows in {leftoverRowsFileName} to {leftoverFileName}')
 
 # Connect to Serial port at COM6 to read sensor readings
 # TODO: Replace COM6 with port at which board is (if different)
 try:
-    # Connect to COM6, baudrate 115200 and specified timeout for readlines()
-    arduino = serial.Serial('COM6', 115200, timeout=.1)
-    time.sleep(1) # Give the connection a second to settle
+    # Connect to COM6, baudrate 115200 and specified timeout for read(). No other application may
+    # open the port while connected
+    arduino = serial.Serial(port='COM6', baudrate=115200, timeout=.1, exclusive=True)
+    try:
+        # Reduce per-byte latency of USB-serial adapters (Linux only, ignored elsewhere)
+        arduino.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, ValueError, IOError):
+        pass
+    # The board may already be sending data, so discard anything received before connecting
+    # and skip ahead to the start of the next line (waiting up to a second for it)
+    arduino.reset_input_buffer()
+    arduino.timeout = 1
+    arduino.read_until(b'\n')
+    arduino.timeout = .1
 except serial.SerialException:
     # SerialException thrown if the board is not connected to the PC or another
     # application is accessing the serial connection at this time 
@@ -24,22 +185,20 @@ except serial.SerialException:
 # To read more about config files, visit BME AI Studio Documentation
 
 # Get config file name with .bmeconfig extension from current folder
-configFiles = glob.glob('*.bmeconfig')
+configFiles = list(itertools.islice(Path('.').glob('*.bmeconfig'), 2)) # Stop looking after a second file
 if (len(configFiles) > 1):
     print("Please check that only one config file is in the currect directory")
     exit()
-configFileName = configFiles.pop()
+configFileName = str(configFiles[0])
 
-# Read config json from config file and remove whitespace
-configFile = open(configFileName, 'r')
-configJson = ""
-for line in configFile.readlines():
-    configJson += line.strip()
+# Read config json from config file (JSON parsers ignore the whitespace between values)
+with open(configFileName, 'rb') as configFile:
+    configJson = configFile.read()
 
 # Decode config json and store in dictionary
 try:
-    rawDataDict = json.loads(configJson)
-except JSONDecodeError:
+    rawDataDict = loadJson(configJson)
+except ValueError: # JSONDecodeError of every JSON library is a ValueError
     print('Could not parse JSON')
 
 #################### SET SENSOR SETTINGS ##########################
@@ -64,97 +223,99 @@ uniqueBoardID = 683422375
 
 # Parameters (within raw data header)
 counterPowerOnOff = 0
-seedPowerOnOff = (int)(random.random() * 10000000) # generate unique seed for this measurement session
+seedPowerOnOff = secrets.randbits(24) # generate unique seed for this measurement session
 counterFileLimit = 0
 
 # Create a datetime object
 curr = datetime.datetime.now()
 
-# Create file name and open new file to save bme raw data json
+# Create file name to save bme raw data json
 fileName = f'{curr.strftime("%Y_%m_%d_%H_%M")}_'
 fileName += f'Board_{uniqueBoardID}_PowerOnOff_{counterPowerOnOff}_{seedPowerOnOff}_File_{counterFileLimit}.bmerawdata'
-if (len(glob.glob(fileName)) == 0): # If there are no other files with the same name:
-    file = open(fileName, "a") # Open for writing/appending
+if os.path.exists(fileName): # Do not overwrite another file with the same name
+    print(f'{fileName} already exists')
+    exit()
 
 # Add raw data header to rawDataDict, leaving out date/time, firmware and boardID
 rawDataDict.update({'rawDataHeader':{'counterPowerOnOff':counterPowerOnOff, 'seedPowerOnOff':seedPowerOnOff, 'counterFileLimit':counterFileLimit}})
 
 # Add raw data body and data columns to rawDataDict
-rawDataDict['rawDataBody'] = {'dataColumns':[{"name": "Sensor Index","unit": "","format": "integer","key": "sensor_index"}]}
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Sensor ID","unit": "","format": "integer","key": "sensor_id"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Time Since PowerOn","unit": "Milliseconds","format": "integer","key": "timestamp_since_poweron"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Real time clock","unit": "Unix Timestamp: seconds since Jan 01 1970. (UTC); 0 = missing","format": "integer","key": "real_time_clock"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Temperature","unit": "DegreesCelcius","format": "float","key": "temperature"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Pressure","unit": "Hectopascals","format": "float","key": "pressure"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Relative Humidity","unit": "Percent","format": "float","key": "relative_humidity"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Resistance Gassensor","unit": "Ohms","format": "float","key": "resistance_gassensor"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Heater Profile Step Index","unit": "","format": "integer","key": "heater_profile_step_index"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Scanning Mode Enabled","unit": "","format": "integer","key": "scanning_mode_enabled"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Label Tag","unit": "","format": "integer","key": "label_tag"})
-rawDataDict['rawDataBody']['dataColumns'].append({"name": "Error Code","unit": "","format": "integer","key": "error_code"})
-rawDataDict['rawDataBody']['dataBlock'] = []
+rawDataDict['rawDataBody'] = {'dataColumns': list(dataColumns), 'dataBlock': []}
 
 # Update raw data header with date/time, firmware and boardId (to get a closer date/time)
-rawDataDict['rawDataHeader']['dateCreated'] = f'{int(time.time())}'
-rawDataDict['rawDataHeader']['dateCreated_ISO'] = f'{datetime.datetime.utcnow().isoformat()}'
+dateCreated = time.time() # Same point in time for the Unix timestamp and the ISO date
+rawDataDict['rawDataHeader']['dateCreated'] = f'{int(dateCreated)}'
+rawDataDict['rawDataHeader']['dateCreated_ISO'] = f'{datetime.datetime.utcfromtimestamp(dateCreated).isoformat()}'
 rawDataDict['rawDataHeader']['firmwareVersion'] = '1.5.0'
 rawDataDict['rawDataHeader']['boardId'] = uniqueBoardID
 
+# Write raw data json up to the empty data block to the file. dataBlock is the last
+# value in rawDataDict, so stripping the closing ']}}' leaves the data block open
+# for the rows, which are added from the rows file at the end of the session
+with open(fileName, "wb") as file:
+    file.write(dumpJson(rawDataDict)[:-3])
+
+# Rows are saved to a binary rows file while collecting data and converted to json at the end
+rowsFileName = fileName[:-len('.bmerawdata')] + '.rows.bin'
+rowsFile = open(rowsFileName, "w+b", buffering=writeBufferSize)
+if not lockFile(rowsFile): # Another session is converting the new rows file as a leftover
+    print(f'Could not lock {rowsFileName}, please try again')
+    exit()
+rowCount = 0 # Number of rows saved to rows file
+
 ########################### DATA COLLECTION ###############################
 
-# Start collecting data and adding to the rawDataDict
-while True: # Loop runs till Ctrl+C, continously reads off data from serial port
+# Bytes read from the serial port that do not form a complete line yet
+buffer = bytearray()
+
+# Start collecting data and saving it to the rows file
+try:
+    while True: # Loop runs till Ctrl+C, continously reads off data from serial port
+        # Read every byte waiting on the serial port at once (at least one, so read() waits for timeout)
+        buffer += arduino.read(arduino.in_waiting or 1)
+        now_s = int(time.time()) # Real time clock for all rows in this read, in seconds
+
+        # Process every complete line in the buffer, the incomplete remainder is kept for the next read
+        while b'\n' in buffer:
+            line, _, buffer = buffer.partition(b'\n')
+            if not line: # Check for blank lines
+                continue
+
+            # Parse comma separated raw data into a row and save it to the rows file
+            row = parse_row(bytes(line), now_s)
+            if debug:
+                print(row) # Print to console for sanity check
+            rowsFile.write(packRow(*row))
+            rowCount += 1
+            if rowCount % flushInterval == 0:
+                rowsFile.flush()
+            if rowCount % progressInterval == 0:
+                print(f'{rowCount} rows collected')
+
+# In case serial connection is interrupted, stop and save file
+except serial.SerialException:
+    print('Serial connection interrupted.')
+
+# If data from serial connection cannot be parsed (wrong format):
+except ValueError:
+    print('Please check that raw_data.ino has been uploaded to board')
+
+# Press Ctrl+C to stop recording data to file
+except KeyboardInterrupt:
+    print('End of measurement session')
+
+# Convert rows file to json and write the rows to the data block in the bmerawdata file. This
+# runs however the session ends; if it fails, the rows file is converted on the next run
+finally:
     try:
-        # Read a line of output from serial port, store it in a Python dictionary to be processed
-        data = arduino.readline().decode()
-        if data: # Check for blank lines/ whitespace
-
-            # Get comma separated raw data
-            arduinoData = data.strip().split(',')
-            if len(arduinoData) == 0: # If checkSensorStatus() returns error or warning
-                print(arduinoData[0]) # Print the warning and break out of loop
-                break
-            
-            # Label raw data from comma seperated output to store in dictionary
-            sensorIndex = int(arduinoData[0])
-            sensorID = int(arduinoData[1])
-            timestamp = int(arduinoData[2])
-            temp = float(arduinoData[3])
-            press = float(arduinoData[4])
-            hum = float(arduinoData[5])
-            gasResis = float(arduinoData[6])
-            heaterIndex = int(arduinoData[8]) # Heater profile Step index
-            scanMode = 1
-            labelTag = 0
-            errCode = int(arduinoData[7])
-
-            # Add row to data block in raw data body
-            row = [sensorIndex, sensorID, timestamp, int(time.time()), temp, press, hum, gasResis, heaterIndex, scanMode, labelTag, errCode]
-            print(row) # Print to console for sanity check
-            rawDataDict['rawDataBody']['dataBlock'].append(row)
-
-    # In case serial connection is interrupted, break and save file
-    except serial.SerialException:
-        print('Serial connection interrupted.')
-        break
-
-    # If data from serial connection cannot be parsed (wrong format):
-    except ValueError:
-        print('Please check that raw_data.ino has been uploaded to board')
-        break
-
-    # Press Ctrl+C to stop recording data to file
-    except KeyboardInterrupt:
-        print('End of measurement session')
-        break
-        
+        with rowsFile: # Closing the rows file releases its lock
+            convertRows(fileName, rowsFile)
+        os.remove(rowsFileName) # All rows are saved in the raw data file now
+    except (OSError, ValueError):
+        print(f'Could not save rows to {fileName}, they are kept in {rowsFileName}')
+
 # Print raw data dict to console for sanity check/ debugging
 # print(rawDataDict)
 
-# Convert raw data dict to json and save to bmerawdata file 
-json = json.dumps(rawDataDict)
-file.write(json)
-file.close() # Close raw data file
-
 # Close serial port connection
 arduino.close()
\ No newline at end of file
@@ -0,0 +1,12 @@
+# Builds the optional parse_row extension used by rawdata.py and rawdata_auto.py to
+# parse the serial data from the board. Requires Cython and a C compiler. Run:
+#     python setup.py build_ext --inplace
+# and copy the built parse_row module to the project folder next to rawdata.py.
+
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name='parse_row',
+    ext_modules=cythonize('parse_row.pyx'),
+)
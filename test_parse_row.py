@@ -0,0 +1,85 @@
+# Checks that the parse_row extension (see setup.py) and the Python parser in rawdata.py and
+# rawdata_auto.py accept the same lines and return the same rows. Build the extension, then run:
+#     python -m pytest test_parse_row.py
+
+import ast, math
+from pathlib import Path
+
+import pytest
+
+parse_row = pytest.importorskip('parse_row').parse_row
+
+def loadPythonParser(scriptName):
+    """Return the parse_row function a script defines when the parse_row extension is not built"""
+    tree = ast.parse(Path(__file__).with_name(scriptName).read_text())
+    for node in tree.body:
+        if isinstance(node, ast.Try) and any(isinstance(statement, ast.ImportFrom) and statement.module == 'parse_row' for statement in node.body):
+            namespace = {'math': math}
+            exec(compile(ast.Module(body=node.handlers[0].body, type_ignores=[]), scriptName, 'exec'), namespace)
+            return namespace['parse_row']
+    raise LookupError(f'No parse_row fallback in {scriptName}')
+
+pythonParsers = [loadPythonParser('rawdata.py'), loadPythonParser('rawdata_auto.py')]
+
+lines = [
+    b'0,12345,67890,25.5,101325.0,45.25,12000.5,0,3',
+    b'0,12345,67890,25.5,101325.0,45.25,12000.5,0,3\r',
+    b'0,12345,67890,25.5,101325.0,45.25,12000.5,0,3,extra',
+    b'0,12345,67890,25.5,101325.0,45.25,12000.5,0,3,\xff',
+    b' 0 , 1 ,\t2, 3.5 ,4e2,.5,5.,0,3 \v\f',
+    b'0,1,2,3,4,5,6,7,8\x1c',
+    b'0,1,2,3,4,5,6,7,8\x85',
+    b'0\xff,1,2,3,4,5,6,7,8',
+    b'0,1,2,3,4,5,6,7',
+    b'',
+    b'\r',
+    b'Sensor Warning: x',
+    b'0,1,2,3,4,5,6,7,',
+    b'0,1,,3,4,5,6,7,8',
+    b'0,1,2,3,4,5,6,7,8\x00',
+    b'0x1,1,2,3,4,5,6,7,8',
+    b'0,1,2,0x1p3,4,5,6,7,8',
+    b'0,1,2,3,4,5,6,7,1_0',
+    b'0,1,2,1_0.5,4,5,6,7,8',
+    b'0,1,2,3,4,5,6,7,_1',
+    b'+0,-1,007,+3,-4,5,6,7,8',
+    b'--1,1,2,3,4,5,6,7,8',
+    b'0,1,2,3-1,4,5,6,7,8',
+    b'0,1,2,3e,4,5,6,7,8',
+    b'0,1,2,.,4,5,6,7,8',
+    b'9223372036854775807,-9223372036854775808,2,3,4,5,6,7,8',
+    b'9223372036854775808,1,2,3,4,5,6,7,8',
+    b'0,-9223372036854775809,2,3,4,5,6,7,8',
+    b'0,1,2,3,4,5,6,7,9_223_372_036_854_775_808',
+    b'0,1,2,1e400,4,5,6,7,8',
+    b'0,1,2,-1e400,4,5,6,7,8',
+    b'0,1,2,1_0e400,4,5,6,7,8',
+    b'0,1,2,1e-400,2.5e-310,5,6,7,8',
+    b'0,1,2,1.7976931348623157e308,4,5,6,7,8',
+    b'0,1,2,inf,-Infinity,+INF,nan,7,8',
+    b'0,1,2,NaN,-nan,5,6,7,8',
+    b'0,1,2,nan(1),4,5,6,7,8',
+    b'0,1,2,infinit,4,5,6,7,8',
+    b'0,1,2,ovf,4,5,6,7,8',
+    b'0,1,2,3,4,5,6,7,8 9',
+]
+
+def parse(parser, line):
+    try:
+        return parser(line, 1700000000)
+    except ValueError:
+        return ValueError
+
+@pytest.mark.parametrize('line', lines)
+def test_parsers_agree(line):
+    expected = parse(parse_row, line)
+    for pythonParser in pythonParsers:
+        row = parse(pythonParser, line)
+        if expected is ValueError or row is ValueError:
+            assert row is expected
+        else:
+            assert [type(value) for value in row] == [type(value) for value in expected]
+            assert [value if value == value else 'nan' for value in row] == [value if value == value else 'nan' for value in expected]
+
+def test_valid_row():
+    assert parse_row(b'0,12345,67890,25.5,101325.0,45.25,12000.5,0,3\r', 1700000000) == (0, 12345, 67890, 1700000000, 25.5, 101325.0, 45.25, 12000.5, 3, 1, 0, 0)